@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-15 21:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0002_alter_user_options_alter_user_stripe_customer_id"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="stripe_customer_data_hash",
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-15 21:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0003_user_stripe_customer_data_hash"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="user",
+            name="stripe_customer_id",
+            field=models.CharField(
+                db_index=True, editable=False, max_length=128, null=True
+            ),
+        ),
+    ]
@@ -1,31 +1,34 @@
 from __future__ import annotations
 
+from functools import cached_property
 from typing import Any
 
+from django.core.signals import setting_changed
+
 
 class AppSettings:
-    @property
+    @cached_property
     def SALESMAN_STRIPE_SECRET_KEY(self) -> str:
         """
         Stripe API secret key.
         """
         return str(self._required_setting("SALESMAN_STRIPE_SECRET_KEY"))
 
-    @property
+    @cached_property
     def SALESMAN_STRIPE_WEBHOOK_SECRET(self) -> str:
         """
         Stripe webhook secret.
         """
         return str(self._required_setting("SALESMAN_STRIPE_WEBHOOK_SECRET"))
 
-    @property
+    @cached_property
     def SALESMAN_STRIPE_PAYMENT_LABEL(self) -> str:
         """
         Payment method label used when displayed in the basket.
         """
         return str(self._setting("SALESMAN_STRIPE_PAYMENT_LABEL", "Pay with Stripe"))
 
-    @property
+    @cached_property
     def SALESMAN_STRIPE_DEFAULT_CURRENCY(self) -> str:
         """
         Default ISO currency used for payments, must be set to a valid Stripe currency.
@@ -33,27 +36,35 @@ class AppSettings:
         """
         return str(self._setting("SALESMAN_STRIPE_DEFAULT_CURRENCY", "USD"))
 
-    @property
+    @cached_property
     def SALESMAN_STRIPE_CANCEL_URL(self) -> str:
         """
         URL to redirect to when Stripe payment is cancelled.
         """
         return str(self._setting("SALESMAN_STRIPE_CANCEL_URL", default=""))
 
-    @property
+    @cached_property
     def SALESMAN_STRIPE_SUCCESS_URL(self) -> str:
         """
         URL to redirect to when Stripe payment is successfull.
         """
         return str(self._setting("SALESMAN_STRIPE_SUCCESS_URL", default=""))
 
-    @property
+    @cached_property
     def SALESMAN_STRIPE_PAID_STATUS(self) -> str:
         """
         Default paid status for fullfiled orders.
         """
         return str(self._setting("SALESMAN_STRIPE_PAID_STATUS", "PROCESSING"))
 
+    def reload(self) -> None:
+        """
+        Clear cached settings so they are read again on next access.
+        """
+        for name in list(self.__dict__):
+            if name.startswith("SALESMAN_STRIPE_"):
+                delattr(self, name)
+
     def _setting(self, name: str, default: Any = None) -> Any:
         from django.conf import settings
 
@@ -72,3 +83,11 @@ class AppSettings:
 
 
 app_settings = AppSettings()
+
+
+def reload_app_settings(setting: str, **kwargs: Any) -> None:
+    if setting.startswith("SALESMAN_STRIPE_"):
+        app_settings.reload()
+
+
+setting_changed.connect(reload_app_settings)
@@ -6,14 +6,26 @@ class StripeCustomerMixin(models.Model):  # type: ignore
     Abstract model that enables saving Stripe customer ID relation to the User model.
 
     To enable this feature your custom `AUTH_USER_MODEL` should inherit from this class
-    or implement the `stripe_customer_id` field itself.
+    or implement the `stripe_customer_id` field itself. An optional
+    `stripe_customer_data_hash` field is used to skip updating the Stripe customer
+    when its data hasn't changed since the last checkout.
 
     You can further control where the Stripe customer ID is stored for the User
     by overriding the `get_stripe_customer_id` and `save_stripe_customer_id`
     methods in the `salesman_stripe.payment.StripePayment` class.
     """
 
-    stripe_customer_id = models.CharField(max_length=128, null=True, editable=False)
+    stripe_customer_id = models.CharField(
+        max_length=128,
+        null=True,
+        editable=False,
+        db_index=True,
+    )
+    stripe_customer_data_hash = models.CharField(
+        max_length=64,
+        null=True,
+        editable=False,
+    )
 
     class Meta:
         abstract = True
@@ -1,31 +1,120 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+import json
 import logging
-from decimal import Decimal
-from typing import Any, TypeVar
+from decimal import ROUND_HALF_EVEN, Decimal
+from types import ModuleType
+from typing import Any, Callable, TypeVar
 
 import stripe
 from django.core.exceptions import FieldDoesNotExist
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import Model
+from django.db.models.options import Options
 from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest
 from django.shortcuts import redirect, render
-from django.urls import URLPattern, URLResolver, path, reverse
+from django.urls import (
+    URLPattern,
+    URLResolver,
+    get_script_prefix,
+    get_urlconf,
+    path,
+    reverse,
+)
 from django.utils.decorators import method_decorator
+from django.utils.translation import get_language
 from django.views.decorators.csrf import csrf_exempt
 from salesman.basket.models import BaseBasket
 from salesman.checkout.payment import PaymentError, PaymentMethod
 from salesman.core.utils import get_salesman_model
 from salesman.orders.models import BaseOrder, BaseOrderPayment
-from stripe.error import SignatureVerificationError, StripeError
+from stripe.error import InvalidRequestError, SignatureVerificationError, StripeError
 from stripe.stripe_object import StripeObject
 
 from .conf import app_settings
 
-stripe.api_key = app_settings.SALESMAN_STRIPE_SECRET_KEY
+json_loads: Callable[[str | bytes], Any]
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 logger = logging.getLogger(__name__)
 
 BasketOrOrder = TypeVar("BasketOrOrder", BaseBasket, BaseOrder)
 
+# Quantum used to round amounts in cents to a whole number.
+_CENTS = Decimal("1")
+
+# Object kinds that can be encoded in a Stripe reference ID.
+_REFERENCE_KINDS = frozenset(("basket", "order"))
+
+_api_key_set = False
+
+
+def _ensure_api_key() -> None:
+    """
+    Set Stripe API key from settings on first use instead of at import time.
+    """
+    global _api_key_set
+    if not _api_key_set:
+        stripe.api_key = app_settings.SALESMAN_STRIPE_SECRET_KEY
+        _api_key_set = True
+
+
+def _reset_api_key(setting: str, **kwargs: Any) -> None:
+    global _api_key_set
+    if setting == "SALESMAN_STRIPE_SECRET_KEY":
+        _api_key_set = False
+
+
+setting_changed.connect(_reset_api_key)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_reverse(
+    viewname: str,
+    prefix: str,
+    urlconf: str | ModuleType | None,
+    language: str | None,
+) -> str:
+    url: str = reverse(viewname, urlconf=urlconf)
+    return url
+
+
+def _reverse(viewname: str) -> str:
+    """
+    Reverse URL for the given view name, cached per script prefix, urlconf
+    and active language.
+    """
+    prefix = get_script_prefix()
+    return _cached_reverse(viewname, prefix, get_urlconf(), get_language())
+
+
+def _clear_reverse_cache(setting: str, **kwargs: Any) -> None:
+    if setting == "ROOT_URLCONF":
+        _cached_reverse.cache_clear()
+
+
+setting_changed.connect(_clear_reverse_cache)
+
+
+@functools.lru_cache(maxsize=None)
+def _has_field(opts: Options[Model], name: str) -> bool:
+    """
+    Check if model options contain a field with given name, cached per model.
+    """
+    try:
+        opts.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    return True
+
 
 class StripePayment(PaymentMethod):  # type: ignore
     """
@@ -35,6 +124,9 @@ class StripePayment(PaymentMethod):  # type: ignore
     identifier = "stripe"
     label = app_settings.SALESMAN_STRIPE_PAYMENT_LABEL
 
+    # Webhook event types passed to `handle_webhook_event`, others are ignored.
+    webhook_event_types = ["checkout.session.completed"]
+
     def get_urls(self) -> list[URLPattern | URLResolver]:
         """
         Register Stripe views.
@@ -77,6 +169,16 @@ class StripePayment(PaymentMethod):  # type: ignore
         """
         Creates a stripe checkout session object for the given Basket or Order.
         """
+        _ensure_api_key()
+        session_data = self.get_stripe_session_data(obj, request)
+        try:
+            return stripe.checkout.Session.create(**session_data)
+        except InvalidRequestError as e:
+            if e.param != "customer" or not self.get_stripe_customer_data_hash(obj):
+                raise
+        # Stored customer is no longer valid on Stripe, clear the data hash
+        # to force a customer update (or create) and retry once.
+        self.save_stripe_customer_data_hash(obj, None)
         session_data = self.get_stripe_session_data(obj, request)
         return stripe.checkout.Session.create(**session_data)
 
@@ -95,8 +197,8 @@ class StripePayment(PaymentMethod):  # type: ignore
 
         return {
             "mode": "payment",
-            "cancel_url": request.build_absolute_uri(reverse("stripe-cancel")),
-            "success_url": request.build_absolute_uri(reverse("stripe-success")),
+            "cancel_url": request.build_absolute_uri(_reverse("stripe-cancel")),
+            "success_url": request.build_absolute_uri(_reverse("stripe-success")),
             "client_reference_id": self.get_reference(obj),
             "customer": customer.id,
             "line_items": self.get_stripe_line_items_data(obj, request),
@@ -113,18 +215,18 @@ class StripePayment(PaymentMethod):  # type: ignore
         See available data to be set in Stripe:
         https://stripe.com/docs/api/checkout/sessions/create#create_checkout_session-line_items
         """
+        items = obj.get_items()
         return [
             {
                 "price_data": {
                     "currency": self.get_currency(request),
-                    "unit_amount": int(obj.total * 100),
+                    "unit_amount": int(
+                        (obj.total * 100).quantize(_CENTS, rounding=ROUND_HALF_EVEN)
+                    ),
                     "product_data": {
-                        "name": f"Purchase {len(obj.get_items())} items",
+                        "name": f"Purchase {len(items)} items",
                         "description": ", ".join(
-                            [
-                                f"{item.quantity}x {item.name}"
-                                for item in obj.get_items()
-                            ]
+                            [f"{item.quantity}x {item.name}" for item in items]
                         ),
                     },
                 },
@@ -138,10 +240,19 @@ class StripePayment(PaymentMethod):  # type: ignore
         request: HttpRequest,
     ) -> StripeObject:
         """
-        Creates or updates the Stripe customer.
+        Creates or updates the Stripe customer. Update is skipped when customer
+        data hasn't changed since it was last sent to Stripe, in which case
+        a customer object containing only the `id` is returned.
         """
+        _ensure_api_key()
         customer_data = self.get_stripe_customer_data(obj, request)
+        data_hash = hashlib.sha256(
+            json.dumps(customer_data, sort_keys=True, default=str).encode()
+        ).hexdigest()
         customer_id = self.get_stripe_customer_id(obj)
+        if customer_id and self.get_stripe_customer_data_hash(obj) == data_hash:
+            # Customer is up to date on Stripe, avoid the extra request.
+            return stripe.Customer.construct_from({"id": customer_id}, stripe.api_key)
         if customer_id:
             try:
                 customer = stripe.Customer.modify(customer_id, **customer_data)
@@ -150,6 +261,7 @@ class StripePayment(PaymentMethod):  # type: ignore
         if not customer_id:
             customer = stripe.Customer.create(**customer_data)
             self.save_stripe_customer_id(obj, customer.id)
+        self.save_stripe_customer_data_hash(obj, data_hash)
         return customer
 
     def get_stripe_customer_data(
@@ -183,18 +295,41 @@ class StripePayment(PaymentMethod):  # type: ignore
         """
         Saves the new Stripe customer ID for Basket or Order.
         """
+        if obj.user and _has_field(obj.user._meta, "stripe_customer_id"):
+            obj.user.stripe_customer_id = customer_id
+            User = type(obj.user)
+            User._default_manager.filter(pk=obj.user.pk).update(
+                stripe_customer_id=customer_id
+            )
+
+    def get_stripe_customer_data_hash(self, obj: BasketOrOrder) -> str | None:
+        """
+        Retrieves hash of Stripe customer data last sent for Basket or Order.
+        """
         if obj.user:
-            try:
-                obj.user._meta.get_field("stripe_customer_id")
-                obj.user.stripe_customer_id = customer_id
-                obj.user.save(update_fields=["stripe_customer_id"])
-            except FieldDoesNotExist:
-                pass
+            return getattr(obj.user, "stripe_customer_data_hash", None)
+        return None
+
+    def save_stripe_customer_data_hash(
+        self,
+        obj: BasketOrOrder,
+        data_hash: str | None,
+    ) -> None:
+        """
+        Saves hash of Stripe customer data sent for Basket or Order.
+        """
+        if obj.user and _has_field(obj.user._meta, "stripe_customer_data_hash"):
+            obj.user.stripe_customer_data_hash = data_hash
+            User = type(obj.user)
+            User._default_manager.filter(pk=obj.user.pk).update(
+                stripe_customer_data_hash=data_hash
+            )
 
     def refund_payment(self, payment: BaseOrderPayment) -> bool:
         """
         Refund payment on Stripe.
         """
+        _ensure_api_key()
         try:
             stripe.Refund.create(payment_intent=payment.transaction_id)
         except StripeError as e:
@@ -221,12 +356,10 @@ class StripePayment(PaymentMethod):  # type: ignore
         """
         Parses the Stripe reference ID returning the object kind and ID.
         """
-        try:
-            kind, id = reference.split("_")
-            assert kind in ("basket", "order")
+        kind, sep, id = (reference or "").partition("_")
+        if sep and kind in _REFERENCE_KINDS:
             return kind, id
-        except Exception:
-            return None, None
+        return None, None
 
     @classmethod
     def cancel_view(cls, request: HttpRequest) -> HttpResponse:
@@ -252,13 +385,17 @@ class StripePayment(PaymentMethod):  # type: ignore
         """
         Webhook view that is accessed asynchronously from Stripe.
         """
-        payload = request.body
+        _ensure_api_key()
         sig_header = request.META.get("HTTP_STRIPE_SIGNATURE", None)
         secret = app_settings.SALESMAN_STRIPE_WEBHOOK_SECRET
-        event = None
+        tolerance = stripe.Webhook.DEFAULT_TOLERANCE
 
         try:
-            event = stripe.Webhook.construct_event(payload, sig_header, secret)
+            payload = request.body.decode("utf-8")
+            stripe.WebhookSignature.verify_header(
+                payload, sig_header, secret, tolerance
+            )
+            data = json_loads(payload)
         except ValueError as e:
             logger.error(e)
             return HttpResponseBadRequest("Invalid payload")
@@ -266,6 +403,12 @@ class StripePayment(PaymentMethod):  # type: ignore
             logger.error(e)
             return HttpResponseBadRequest("Invalid signature")
 
+        # Avoid constructing a Stripe object for events that are not handled.
+        if data.get("type") not in cls.webhook_event_types:
+            logger.debug("Webhook event ignored: %s", data.get("type"))
+            return HttpResponse("Event ignored")
+
+        event = stripe.Event.construct_from(data, stripe.api_key)
         return cls.handle_webhook_event(request, event)
 
     @classmethod
@@ -277,12 +420,13 @@ class StripePayment(PaymentMethod):  # type: ignore
         """
         Handles event returned from Stripe.
         """
-        if event.type == "checkout.session.completed":
-            session = event.data.object
+        if event["type"] == "checkout.session.completed":
+            session = event["data"]["object"]
             return cls.handle_webhook_session_completed(request, session)
         return HttpResponse("Event ignored")
 
     @classmethod
+    @transaction.atomic  # type: ignore
     def handle_webhook_session_completed(
         cls,
         request: HttpRequest,
@@ -290,37 +434,52 @@ class StripePayment(PaymentMethod):  # type: ignore
     ) -> HttpResponse:
         """
         Fullfill order after a successfull webhook request for session.
+        Runs in a transaction with the basket or order row locked and skips
+        sessions that were already fulfilled, since Stripe may deliver the same
+        event more than once, including concurrently.
         """
         Basket = get_salesman_model("Basket")
         Order = get_salesman_model("Order")
+        OrderPayment = get_salesman_model("OrderPayment")
 
-        kind, id = cls.parse_reference(session.client_reference_id)
+        kind, id = cls.parse_reference(session["client_reference_id"])
         if kind == "basket":
-            try:
-                basket = Basket.objects.get(id=id)
-            except BaseBasket.DoesNotExist:
-                logger.error(f"Missing basket: {id}")
-                return HttpResponseBadRequest("Missing basket")
-
-            kwargs = {"status": app_settings.SALESMAN_STRIPE_PAID_STATUS}
-            order = Order.objects.create_from_basket(basket, request, **kwargs)
-            basket.delete()
+            queryset = Basket.objects.all()
         elif kind == "order":
-            try:
-                order = Order.objects.get(id=id)
-            except BaseOrder.DoesNotExist:
-                logger.error(f"Missing order: {id}")
-                return HttpResponseBadRequest("Missing order")
+            queryset = Order.objects.all()
         else:
-            logger.error(f"Invalid session reference: {session.id}")
+            logger.error("Invalid session reference: %s", session["id"])
             return HttpResponseBadRequest("Invalid session reference")
 
+        # Lock the row so concurrent deliveries of the same session wait here
+        # and see the payment created by the first one.
+        obj = queryset.select_for_update().filter(id=id).first()
+
+        payments = OrderPayment.objects.filter(
+            transaction_id=session["payment_intent"],
+            payment_method=cls.identifier,
+        )
+        if session["payment_intent"] and payments.exists():
+            logger.info("Session already processed: %s", session["id"])
+            return HttpResponse("Already processed")
+
+        if obj is None:
+            logger.error("Missing %s: %s", kind, id)
+            return HttpResponseBadRequest(f"Missing {kind}")
+
+        if kind == "basket":
+            kwargs = {"status": app_settings.SALESMAN_STRIPE_PAID_STATUS}
+            order = Order.objects.create_from_basket(obj, request, **kwargs)
+            obj.delete()
+        else:
+            order = obj
+
         # Capture payment on order.
         order.pay(
-            amount=Decimal(session.amount_total / 100),
-            transaction_id=session.payment_intent,
+            amount=Decimal(session["amount_total"]) / 100,
+            transaction_id=session["payment_intent"],
             payment_method=cls.identifier,
         )
 
-        logger.info(f"Order fulfilled: {order.ref}")
+        logger.info("Order fulfilled: %s", order.ref)
         return HttpResponse("Order fulfilled")